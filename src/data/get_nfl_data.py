@@ -3,7 +3,12 @@ import click
 import numpy as np
 import pandas as pd
 import nfl_data_py as nfl
+from numba import njit, prange
+from pandas.api.types import union_categoricals
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_DIRECTORY = 'cache'
 
 def convert_height_to_inches(height_string: str) -> int:
     """
@@ -81,13 +86,108 @@ def half_ppr_scoring(
     
     return half_ppr_score
 
-def pull_data_from_nfl_data_py(start_year: int, end_year: int) -> [pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+@njit(parallel=True, fastmath=True, cache=True)
+def half_ppr_scoring_kernel(
+    rushing_tds: np.ndarray, 
+    receiving_tds: np.ndarray, 
+    rushing_yards: np.ndarray, 
+    receiving_yards: np.ndarray,
+    receptions: np.ndarray,
+    passing_tds: np.ndarray,
+    interceptions: np.ndarray,
+    fumbles: np.ndarray,
+    passing_yards: np.ndarray,
+    two_pt_conversions: np.ndarray,
+    out: np.ndarray
+) -> None:
+    """
+    Compiled, array-wise version of half_ppr_scoring that writes
+    every player's Half-Point-per-Reception score into out.
+    
+    Arguments:
+        rushing_tds (np.ndarray): Number of rushing touchdowns scored by each player.
+        receiving_tds (np.ndarray): Number of receiving touchdowns scored by each player.
+        rushing_yards (np.ndarray): Amount of rushing yards by each player.
+        receiving_yards (np.ndarray): Amount of receiving yards by each player.
+        receptions (np.ndarray): Number of receptions by each player.
+        passing_tds (np.ndarray): Number of passing touchdowns scored by each player.
+        interceptions (np.ndarray): Number of interceptions thrown by each player.
+        fumbles (np.ndarray): Number of times each player fumbled the ball to the opponent.
+        passing_yards (np.ndarray): Number of passing yards thrown by each player.
+        two_pt_conversions (np.ndarray): Number of two point conversions scored by each player.
+        out (np.ndarray): Array the fantasy scores are written to.
+        
+    Returns:
+        None: None.
+    
+    """
+    
+    for i in prange(out.size):
+        out[i] = rushing_tds[i] * 6 + \
+                 receiving_tds[i] * 6 + \
+                 rushing_yards[i] * 0.1 + \
+                 receiving_yards[i] * 0.1 + \
+                 receptions[i] * 0.5 + \
+                 passing_tds[i] * 4 - \
+                 interceptions[i] - \
+                 fumbles[i] * 2 + \
+                 passing_yards[i] * 0.04 + \
+                 two_pt_conversions[i] * 2
+
+def convert_to_shared_categories(columns: list) -> None:
+    """
+    Converts columns across DataFrames into categoricals that share
+    one set of categories, so merges between them join on integer codes.
+    
+    Arguments:
+        columns (list): List of (DataFrame, column name) pairs to convert in place.
+        
+    Returns:
+        None: None.
+    
+    """
+    
+    categories = union_categoricals(
+        [pd.Categorical(df[column]) for df, column in columns]
+    ).categories
+    for df, column in columns:
+        df[column] = pd.Categorical(df[column], categories=categories)
+
+def load_with_cache(name: str, start_year: int, end_year: int, load_function, refresh: bool = False) -> pd.DataFrame:
+    """
+    Loads a raw DataFrame from the local Parquet cache, falling back
+    to load_function and caching its result when no cached copy exists.
+    
+    Arguments:
+        name (str): Name of the dataset, used in the cache filename.
+        start_year (int): The first year of data in the dataset.
+        end_year (int): The last year of data in the dataset.
+        load_function (callable): Function returning the dataset when it is not cached.
+        refresh (bool): Ignore and overwrite any existing cached copy.
+        
+    Returns:
+        pd.DataFrame: The requested dataset.
+    
+    """
+    
+    cache_filepath = os.path.join(CACHE_DIRECTORY, f'{name}_{start_year}_{end_year}.parquet')
+    if not refresh and os.path.exists(cache_filepath):
+        return pd.read_parquet(cache_filepath)
+
+    df = load_function()
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    df.to_parquet(cache_filepath, compression='zstd')
+    return df
+
+def pull_data_from_nfl_data_py(start_year: int, end_year: int, refresh: bool = False, with_injuries: bool = False) -> [pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     helper function to pull data.
 
     Arguments:
         start_year (int): The first year to pull data from.
         end_year (int): The last year to pull data from.
+        refresh (bool): Re-download the data instead of reading it from the cache.
+        with_injuries (bool): Also pull injury reports, otherwise None is returned in their place.
 
     Returns:
         list: List of pandas Dataframes containing NFL data.
@@ -96,24 +196,48 @@ def pull_data_from_nfl_data_py(start_year: int, end_year: int) -> [pd.DataFrame,
     assert end_year > start_year, f'End year must be greater than start year\nstart_year={start_year}\nend_year=={end_year}'
     years_to_analyze = range(start_year, end_year)
 
-    weekly_data = nfl.import_weekly_data(years=years_to_analyze)
-    roster_data = nfl.import_rosters(years=years_to_analyze)
-    snap = nfl.import_snap_counts(years=years_to_analyze)
-    team_info = nfl.import_team_desc()
-    inj = nfl.import_injuries(years_to_analyze)
+    loaders = {
+        'weekly': lambda: nfl.import_weekly_data(years=years_to_analyze),
+        'roster': lambda: nfl.import_rosters(years=years_to_analyze),
+        'snap': lambda: nfl.import_snap_counts(years=years_to_analyze),
+        'team_info': lambda: nfl.import_team_desc(),
+    }
+    if with_injuries:
+        loaders['injuries'] = lambda: nfl.import_injuries(years_to_analyze)
+    with ThreadPoolExecutor(max_workers=len(loaders)) as executor:
+        futures = {
+            name: executor.submit(load_with_cache, name, start_year, end_year, load_function, refresh)
+            for name, load_function in loaders.items()
+        }
+        results = {name: future.result() for name, future in futures.items()}
+
+    weekly_data = results['weekly']
+    roster_data = results['roster']
+    snap = results['snap']
+    team_info = results['team_info']
+    inj = results.get('injuries')
     return [weekly_data, roster_data, snap, team_info, inj]
 
 @click.command()
 @click.option('--start_year', default=2013, help='First year to pull metrics from')
 @click.option('--end_year', default=2021, help='Last year to pull metrics from')
-@click.option('--data_filepath', default='data/data.csv', help='Filepath to save the processed output to.')
-def process_data(start_year: int, end_year: int, data_filepath: str):
+@click.option('--data_filepath', default='data/data.csv', help='Filepath to save the processed output to. The extension is replaced with .parquet unless --csv is passed.')
+@click.option('--refresh', is_flag=True, help='Re-download raw data instead of using the local cache.')
+@click.option('--csv', is_flag=True, help='Save the processed output as CSV instead of Parquet.')
+@click.option('--with-injuries/--no-injuries', default=False, help='Add per-position injury report counts for each team and week.')
+@click.option('--with-matchups/--no-matchups', default=False, help='Add conference and division matchup features.')
+def process_data(start_year: int, end_year: int, data_filepath: str, refresh: bool, csv: bool, with_injuries: bool, with_matchups: bool):
     """
     Downloads, processes, and saves NFL data.
 
     Arguments:
         start_year (int): The first year to pull data from.
         end_year (int): The last year to pull data from.
+        data_filepath (str): Filepath to save the processed output to.
+        refresh (bool): Re-download the raw data instead of reading it from the cache.
+        csv (bool): Save the processed output as CSV instead of Parquet.
+        with_injuries (bool): Add per-position injury report counts for each team and week.
+        with_matchups (bool): Add conference and division matchup features.
 
     Returns:
         None: None.
@@ -131,175 +255,146 @@ def process_data(start_year: int, end_year: int, data_filepath: str):
     click.echo('Downloading raw data...')
     weekly_data, roster_data, snap, team_info, inj = pull_data_from_nfl_data_py(
         start_year,
-        end_year
+        end_year,
+        refresh,
+        with_injuries
     )
 
     click.echo('Processing raw data...')
-    summed = weekly_data.groupby(['player_id', 'season', 'week']).sum().reset_index()
+    weekly_data = weekly_data.drop(
+        ['sacks', 'sack_yards', 'sack_fumbles', 'special_teams_tds'],
+        axis=1
+    )
+    roster_data = roster_data[[
+        'player_id',
+        'season',
+        'team',
+        'position',
+        'first_name',
+        'last_name',
+        'height',
+        'pfr_id',
+        'rookie_year',
+    ]].drop_duplicates(subset=['player_id', 'season'], keep='last')
+    snap = snap[[
+        'pfr_player_id',
+        'season',
+        'week',
+        'game_type',
+        'position',
+        'opponent',
+        'offense_snaps',
+        'offense_pct',
+    ]].drop_duplicates(subset=['pfr_player_id', 'season', 'week'])
+
+    convert_to_shared_categories([
+        (weekly_data, 'player_id'),
+        (roster_data, 'player_id'),
+    ])
+    convert_to_shared_categories([
+        (roster_data, 'pfr_id'),
+        (snap, 'pfr_player_id'),
+    ])
+    convert_to_shared_categories([
+        (roster_data, 'team'),
+        (snap, 'opponent'),
+        (team_info, 'team_abbr'),
+    ])
+    convert_to_shared_categories([
+        (roster_data, 'position'),
+        (snap, 'position'),
+    ])
+    snap['game_type'] = snap['game_type'].astype('category')
+
+    summed = weekly_data.groupby(
+        ['player_id', 'season', 'week'],
+        sort=False,
+        observed=True,
+        as_index=False
+    ).sum(numeric_only=True)
     data = pd.merge(
         left=summed, 
         right=roster_data, 
-        left_on='player_id', 
-        right_on='player_id', 
+        left_on=['player_id', 'season'], 
+        right_on=['player_id', 'season'], 
         how='inner', 
-        suffixes=('', '_DROP')
-    ).filter(regex='^(?!.*_DROP)')
+        suffixes=('', '_DROP'),
+        sort=False,
+        validate='many_to_one'
+    )
+    data = data.loc[:, ~data.columns.str.endswith('_DROP')]
 
-    columns_to_drop = [
-        'sacks',
-        'sack_yards',
-        'sack_fumbles',
-        'espn_id',
-        'sportradar_id',
-        'yahoo_id',
-        'rotowire_id',
-        'pff_id',
-        'fantasy_data_id',
-        'sleeper_id',
-        'esb_id',
-        'gsis_it_id',
-        'smart_id',
-        'ngs_position',
-        'entry_year',
-        'player_name',
-        'birth_date',
-        'jersey_number',
-        'special_teams_tds',
-        'college',
-        'depth_chart_position',
-    ]                  
-    data.drop(columns_to_drop, axis=1, inplace=True)
     data = data[
         data['position'].isin(['WR', 'RB', 'TE', 'QB'])
     ]
     data = data[~data['rookie_year'].isna()]
     data['rookie_year'] = data['rookie_year'].astype(int)
     data['years_exp'] = (data['season'].astype(int) - data['rookie_year'].astype(int))
-    data['height'] = data['height'].apply(lambda height: convert_height_to_inches(height))
-    data.drop('weight', axis=1, inplace=True)
+    height = data['height'].str.split('-', n=1, expand=True)
+    data['height'] = height[0].astype('int16') * 12 + height[1].astype('int16')
     data['first_name'] = data['first_name'].str.lower()
     data['last_name'] = data['last_name'].str.lower()
 
-    data.loc[data['fantasy_points'] > 0, 'status'] = 'Active'
-    data.loc[data['fantasy_points_ppr'] > 0, 'status'] = 'Active'
-
-    rows_to_drop = data.loc[
-        (data['fantasy_points'] <= 0) & (data['status'] != 'Active'),
-        'status'
-    ].index
-    data.drop(rows_to_drop, axis=0, inplace=True)
-    data.drop('status', axis=1, inplace=True)
+    data = data[
+        (data['fantasy_points'] > 0) | (data['fantasy_points_ppr'] > 0)
+    ]
 
     snap = snap[snap['position'].isin(data['position'].unique())]
+    snap = snap[snap['game_type'] == 'REG'].drop('game_type', axis=1)
     data = pd.merge(
         left=data,
         right=snap,
         left_on=['pfr_id', 'season', 'week'],
         right_on=['pfr_player_id', 'season', 'week'],
         how='inner', 
-        suffixes=('', '_DROP')
-    ).filter(regex='^(?!.*_DROP)')
-    data = data[data['game_type'] == 'REG']
+        suffixes=('', '_DROP'),
+        sort=False,
+        validate='many_to_one'
+    )
+    data = data.loc[:, ~data.columns.str.endswith('_DROP')]
 
     columns_to_drop = [
         'pfr_id',
-        'game_id',
-        'pfr_game_id',
-        'game_type',
-        'player',
         'pfr_player_id',
-        'defense_snaps',
-        'defense_pct',
-        'st_snaps',
-        'st_pct',
         'fantasy_points',
         'fantasy_points_ppr',
     ]
-    data.drop(
-        columns_to_drop,
-        axis=1,
-        inplace=True
-    )
-
-    data = pd.merge(
-        left=data,
-        right=team_info[['team_abbr', 'team_conf', 'team_division']],
-        left_on='team',
-        right_on='team_abbr',
-        how='inner',
-    )
-    data = pd.merge(
-        left=data,
-        right=team_info[['team_abbr', 'team_conf', 'team_division']],
-        left_on='opponent',
-        right_on='team_abbr',
-        how='inner',
-    ).rename(
-        columns={
-            'team_abbr_y': 'opponent_abbr', 
-            'team_conf_y': 'opponent_conf', 
-            'team_division_y': 'opponent_division',
-            'team_abbr_x': 'team_abbr',
-            'team_conf_x': 'team_conf',
-            'team_division_x': 'team_division'
-        }
-    )
-    data.drop(
-        ['team_abbr', 'opponent_abbr'],
-        axis=1, 
-        inplace=True
-    )
-
-    # data['division_matchup'] = np.where(
-    #     (data['team_division'] == data['opponent_division']),
-    #     1, 
-    #     0
-    # )
-
-    # data['conference_matchup'] = np.where(
-    #     (data['team_conf'] == data['opponent_conf']),
-    #     1, 
-    #     0
-    # )
-
-    # data = pd.merge(
-    #     left=data,
-    #     right=pd.get_dummies(data['team_conf'], prefix='team'),
-    #     left_index=True,
-    #     right_index=True,
-    #     how='inner'
-    # )
-
-    # data = pd.merge(
-    #     left=data,
-    #     right=pd.get_dummies(data['opponent_conf'], prefix='opponent'),
-    #     left_index=True,
-    #     right_index=True,
-    #     how='inner'
-    # )
-
-    # data = pd.merge(
-    #     left=data,
-    #     right=pd.get_dummies(data['team_division'], prefix='team'),
-    #     left_index=True,
-    #     right_index=True,
-    #     how='inner'
-    # )
-
-    # data = pd.merge(
-    #     left=data,
-    #     right=pd.get_dummies(data['opponent_division'], prefix='opponent'),
-    #     left_index=True,
-    #     right_index=True,
-    #     how='inner'
-    # )
+    columns_to_drop = set(columns_to_drop)
+    data = data[[column for column in data.columns if column not in columns_to_drop]]
+
+    team_conf = dict(zip(team_info['team_abbr'], team_info['team_conf']))
+    team_division = dict(zip(team_info['team_abbr'], team_info['team_division']))
+    data['team_conf'] = data['team'].map(team_conf)
+    data['team_division'] = data['team'].map(team_division)
+    data['opponent_conf'] = data['opponent'].map(team_conf)
+    data['opponent_division'] = data['opponent'].map(team_division)
+    data = data[
+        data['team_conf'].notna() & data['opponent_conf'].notna()
+    ]
 
-    data = pd.merge(
-        left=data,
-        right=pd.get_dummies(data['position']),
-        left_index=True,
-        right_index=True,
-        how='inner'
+    if with_matchups:
+        data['division_matchup'] = (
+            data['team_division'].to_numpy() == data['opponent_division'].to_numpy()
+        ).astype('uint8')
+
+        data['conference_matchup'] = (
+            data['team_conf'].to_numpy() == data['opponent_conf'].to_numpy()
+        ).astype('uint8')
+
+        data = pd.concat(
+            [
+                data,
+                pd.get_dummies(data['team_conf'], prefix='team', dtype='uint8'),
+                pd.get_dummies(data['opponent_conf'], prefix='opponent', dtype='uint8'),
+                pd.get_dummies(data['team_division'], prefix='team', dtype='uint8'),
+                pd.get_dummies(data['opponent_division'], prefix='opponent', dtype='uint8'),
+            ],
+            axis=1
+        )
+
+    data = pd.concat(
+        [data, pd.get_dummies(data['position'].cat.remove_unused_categories(), dtype='uint8')],
+        axis=1
     )
 
     columns_to_drop = [
@@ -308,84 +403,83 @@ def process_data(start_year: int, end_year: int, data_filepath: str):
         'opponent_conf',
         'opponent_division',
         'position',
-        'headshot_url',
-        
     ]
-    data.drop(
-        columns_to_drop,
-        axis=1,
-        inplace=True
-    )
+    columns_to_drop = set(columns_to_drop)
+    data = data[[column for column in data.columns if column not in columns_to_drop]]
     data.insert(0, 'player_id', data.pop('player_id'))
     data.insert(1, 'first_name', data.pop('first_name'))
     data.insert(2, 'last_name', data.pop('last_name'))
     # data.insert(3, 'team', data.pop('team'))
     # data.insert(4, 'opponent', data.pop('opponent'))
 
-    # inj = inj[
-    #     inj['position'].isin(['WR', 'RB', 'TE', 'QB'])
-    # ]
-    # inj = inj[inj['game_type'] == 'REG']
-    # inj['season'] = inj['season'].astype(int)
-    # inj['week'] = inj['week'].astype(int)
-    # inj['report_primary_injury'] = inj['report_primary_injury'].str.lower()
-    # inj['report_secondary_injury'] = inj['report_secondary_injury'].str.lower()
-    # inj['report_status'] = inj['report_status'].str.lower()
-    # inj['practice_primary_injury'] = inj['practice_primary_injury'].str.lower()
-    # inj['practice_secondary_injury'] = inj['practice_secondary_injury'].str.lower()
-    # inj['practice_status'] = inj['practice_status'].str.lower()
-
-    # injuries = pd.DataFrame(
-    #     inj.groupby(['season', 'week', 'team', 'position', ])[['report_status', 'practice_status']].value_counts()
-    # ).reset_index()
-
-    # injuries = pd.get_dummies(
-    #     injuries, 
-    #     columns=['position'], 
-    #     prefix='positional_injuries'
-    # ).groupby(['season', 'week', 'team']).sum().reset_index()
-    # injuries.drop(0, axis=1, inplace=True)
-
-    # data = pd.merge(
-    #     left=data,
-    #     right=injuries,
-    #     left_on=['season', 'week', 'team'],
-    #     right_on=['season', 'week', 'team'],
-    #     how='left'
-    # )
-
-    # data['positional_injuries_QB'] = data['positional_injuries_QB'].fillna(0)
-    # data['positional_injuries_RB'] = data['positional_injuries_RB'].fillna(0)
-    # data['positional_injuries_TE'] = data['positional_injuries_TE'].fillna(0)
-    # data['positional_injuries_WR'] = data['positional_injuries_WR'].fillna(0)
-
-    # data['positional_injuries_QB'] = data['positional_injuries_QB'].astype(int)
-    # data['positional_injuries_RB'] = data['positional_injuries_RB'].astype(int)
-    # data['positional_injuries_TE'] = data['positional_injuries_TE'].astype(int)
-    # data['positional_injuries_WR'] = data['positional_injuries_WR'].astype(int)
-    data.drop_duplicates(inplace=True)
+    if with_injuries:
+        inj = inj[
+            inj['position'].isin(['WR', 'RB', 'TE', 'QB'])
+        ]
+        inj = inj[inj['game_type'] == 'REG']
+        inj['season'] = inj['season'].astype(int)
+        inj['week'] = inj['week'].astype(int)
+
+        injuries = inj.groupby(
+            ['season', 'week', 'team', 'position']
+        ).size().unstack('position', fill_value=0).add_prefix('positional_injuries_').reset_index()
+
+        data = pd.merge(
+            left=data,
+            right=injuries,
+            left_on=['season', 'week', 'team'],
+            right_on=['season', 'week', 'team'],
+            how='left',
+            sort=False,
+            validate='many_to_one'
+        )
+
+        for position in ['QB', 'RB', 'TE', 'WR']:
+            column = f'positional_injuries_{position}'
+            if column not in data.columns:
+                data[column] = 0
+            data[column] = data[column].fillna(0).astype(int)
 
     click.echo('Calculating fantasy score...')
-    data['fantasy_half_ppr'] = data.apply(
-        lambda x: half_ppr_scoring(
-            x.rushing_tds, 
-            x['receiving_tds'],
-            x['rushing_yards'],
-            x['receiving_yards'],
-            x['receptions'],
-            x['passing_tds'],
-            x['interceptions'],
-            x['sack_fumbles_lost'] + x['rushing_fumbles_lost'] + x['receiving_fumbles_lost'],
-            x['passing_yards'],
-            x['passing_2pt_conversions'] + x['rushing_2pt_conversions'] + x['receiving_2pt_conversions']
-        ),
-        axis=1
-    )
-
-    data.to_csv(
-        os.path.join(filepath, filename), 
-        index=None
+    fantasy_half_ppr = np.empty(len(data))
+    half_ppr_scoring_kernel(
+        data['rushing_tds'].to_numpy(dtype=np.float64),
+        data['receiving_tds'].to_numpy(dtype=np.float64),
+        data['rushing_yards'].to_numpy(dtype=np.float64),
+        data['receiving_yards'].to_numpy(dtype=np.float64),
+        data['receptions'].to_numpy(dtype=np.float64),
+        data['passing_tds'].to_numpy(dtype=np.float64),
+        data['interceptions'].to_numpy(dtype=np.float64),
+        data['sack_fumbles_lost'].to_numpy(dtype=np.float64) + \
+        data['rushing_fumbles_lost'].to_numpy(dtype=np.float64) + \
+        data['receiving_fumbles_lost'].to_numpy(dtype=np.float64),
+        data['passing_yards'].to_numpy(dtype=np.float64),
+        data['passing_2pt_conversions'].to_numpy(dtype=np.float64) + \
+        data['rushing_2pt_conversions'].to_numpy(dtype=np.float64) + \
+        data['receiving_2pt_conversions'].to_numpy(dtype=np.float64),
+        fantasy_half_ppr
     )
+    data['fantasy_half_ppr'] = fantasy_half_ppr
+
+    click.echo('Downcasting numeric columns...')
+    for column in ['season', 'week', 'years_exp', 'height']:
+        data[column] = data[column].astype('int16')
+    for column in data.select_dtypes('integer').columns:
+        data[column] = pd.to_numeric(data[column], downcast='integer')
+    for column in data.select_dtypes('float').columns:
+        data[column] = pd.to_numeric(data[column], downcast='float')
+
+    if csv:
+        data.to_csv(
+            os.path.join(filepath, filename), 
+            index=None
+        )
+    else:
+        data.to_parquet(
+            os.path.join(filepath, os.path.splitext(filename)[0] + '.parquet'),
+            compression='zstd',
+            index=False
+        )
     click.echo('Done!')
 
 if __name__ == '__main__':